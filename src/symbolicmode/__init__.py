@@ -8,11 +8,237 @@ Written by Sean Reifschneider and ChatGPT, 2023-04
 """
 
 import os
-import re
-from typing import Union, Iterator, Tuple
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Callable, Union, Iterator, Tuple
 from pathlib import Path
 import stat
 
+#  octal-digit alphabet used to distinguish "755"-style modes from symbolic ones
+_OCTAL_DIGITS = frozenset("01234567")
+
+#  character classes for the instruction scanner
+_USER_CHARS = "ugoa"
+_OP_CHARS = "=+-"
+_PERM_CHARS = "rwxXstugo"
+
+#  translate table that deletes every valid perm char; anything left over
+#  after translating a PERMS span is garbage (validated in one C-level pass)
+_PERM_DELETE = str.maketrans("", "", _PERM_CHARS)
+
+
+def _build_perm_table(x_value: int) -> Tuple[int, ...]:
+    "Build a 256-entry table mapping a perm character's ordinal to its bit value"
+    table = [0] * 256
+    table[ord("r")] = 4
+    table[ord("w")] = 2
+    table[ord("x")] = 1
+    table[ord("X")] = x_value
+    return tuple(table)
+
+
+#  `X` counts as `x` for directories, and for files whose current mode
+#  already has an execute bit set (selected per-instruction below)
+_PERM_FILE = _build_perm_table(0)
+_PERM_DIR = _build_perm_table(1)
+
+#  cached process umask (see _system_umask); the probe is non-atomic, so it
+#  is serialized behind a lock
+_SYSTEM_UMASK: Union[int, None] = None
+_UMASK_LOCK = threading.Lock()
+
+
+def _system_umask() -> int:
+    """Return the process umask, probing it only once.  os.umask can only
+    read the umask by setting it, so the two-syscall probe is serialized
+    behind a lock and cached; call invalidate_umask_cache() (or pass
+    `umask=` explicitly) if the process umask changes after the first call."""
+    global _SYSTEM_UMASK
+    if _SYSTEM_UMASK is None:
+        with _UMASK_LOCK:
+            if _SYSTEM_UMASK is None:
+                umask = os.umask(0)
+                os.umask(umask)
+                _SYSTEM_UMASK = umask
+    return _SYSTEM_UMASK
+
+
+def invalidate_umask_cache() -> None:
+    """Forget the cached process umask so the next default-umask call
+    re-probes it.  Call this after changing the process umask with
+    os.umask() if you rely on the default umask behavior."""
+    global _SYSTEM_UMASK
+    with _UMASK_LOCK:
+        _SYSTEM_UMASK = None
+
+
+def _parse_instructions(permstr: str) -> Iterator[Tuple[str, str, str]]:
+    """Parse the instruction into (lhs, op, rhs).  This also expands
+    multi-operation expressions into multiple u/op/perm tuples.
+
+    This is a single-pass character scan over the `[ugoa]*([=+-][PERMS]*)+`
+    grammar, which is much cheaper than a regex for input this structured.
+    Instructions are walked with str.find rather than split(",") so no
+    intermediate list is allocated."""
+    pos = 0
+    final = len(permstr)
+    while pos <= final:
+        comma = permstr.find(",", pos)
+        if comma < 0:
+            comma = final
+        instruction = permstr[pos:comma]
+        pos = comma + 1
+
+        end = len(instruction)
+        i = 0
+        while i < end and instruction[i] in _USER_CHARS:
+            i += 1
+        user = instruction[:i]
+        if i >= end or instruction[i] not in _OP_CHARS:
+            raise ValueError(f"Invalid instruction: {instruction}")
+        while i < end:
+            op = instruction[i]
+            i += 1
+            start = i
+            while i < end and instruction[i] not in _OP_CHARS:
+                i += 1
+            perm = instruction[start:i]
+            if perm.translate(_PERM_DELETE):
+                raise ValueError(f"Invalid instruction: {instruction}")
+            #  the u/g/o-mix rule is static, so reject it at parse time
+            if len(perm) != 1 and ("u" in perm or "g" in perm or "o" in perm):
+                raise ValueError(
+                    "If u/g/o specified on RHS, only a single letter of u/g/o can be specified"
+                )
+            yield ((user, op, perm))
+
+
+def _sum_premissions(
+    perms_str: str, perm_table: Tuple[int, ...], perm_u: int, perm_g: int, perm_o: int
+) -> int:
+    "Turn the permissions part of the statement into the numeric bits set"
+    #  a single u/g/o on the RHS copies that user's current perms
+    if len(perms_str) == 1 and perms_str in "ugo":
+        return perm_u if perms_str == "u" else perm_g if perms_str == "g" else perm_o
+
+    #  u/g/o mixed with anything else was rejected at parse time, so every
+    #  remaining character maps through the table
+    perms_sum = 0
+    for p in perms_str:
+        perms_sum |= perm_table[ord(p)]
+
+    return perms_sum
+
+
+@lru_cache(maxsize=1024)
+def _instruction_tuple(symbolic_perm: str) -> Tuple[Tuple[str, str, str], ...]:
+    "Tokenize (and validate) a full symbolic mode string, cached per spec"
+    return tuple(_parse_instructions(symbolic_perm))
+
+
+@lru_cache(maxsize=4096)
+def _sym_to_num_cached(
+    symbolic_perm: str, initial_mode: int, is_directory: bool, umask: int
+) -> int:
+    """Cached core of symbolic_to_numeric_permissions.  All arguments are
+    resolved hashable values, so a recursive chmod over a tree with only a
+    few distinct (mode, is_directory) pairs parses each spec only once."""
+
+    # Extract initial permissions and special bits, branch-free
+    special = (initial_mode >> 9) & 0o7
+    perm_u = (initial_mode >> 6) & 0o7
+    perm_g = (initial_mode >> 3) & 0o7
+    perm_o = initial_mode & 0o7
+    setuid_bit = special & 4
+    setgid_bit = special & 2
+    sticky_bit = special & 1
+
+    for users, operation, perms_str in _instruction_tuple(symbolic_perm):
+        if not perms_str:
+            #  "+"/"-" with no perms changes neither perm nor special bits,
+            #  and "=" with no perms is a plain clear: no RHS work either way
+            if operation != "=":
+                continue
+            perm_sum = 0
+        else:
+            #  for a file, `X` only acts as `x` if the current perms have an
+            #  'x' bit set
+            if is_directory or (perm_u | perm_g | perm_o) & 1:
+                perm_table = _PERM_DIR
+            else:
+                perm_table = _PERM_FILE
+
+            perm_sum = _sum_premissions(perms_str, perm_table, perm_u, perm_g, perm_o)
+
+        #  special-bit inputs, shared by the per-user updates below
+        has_s = "s" in perms_str
+        has_t = "t" in perms_str
+        op_eq = operation == "="
+        op_plus_eq = operation != "-"
+
+        #  the umask only applies when no users were given; precompute the
+        #  per-user slices of the mask once per instruction
+        base_mask = ~umask if users == "" else 0o7777
+        mask_u = (base_mask >> 6) & 0o7
+        mask_g = (base_mask >> 3) & 0o7
+        mask_o = base_mask & 0o7
+
+        #  3-bit mask of which of u/g/o the instruction applies to, so each
+        #  users-membership test happens exactly once per instruction
+        if users == "" or "a" in users:
+            user_mask = 7
+        else:
+            user_mask = 0
+            if "u" in users:
+                user_mask |= 4
+            if "g" in users:
+                user_mask |= 2
+            if "o" in users:
+                user_mask |= 1
+
+        # Update the numeric file mode variables based on the users and operation;
+        #  a special bit is set by +/= naming it, kept by +/- not naming it
+        #  (or by = on a directory for suid/sgid), and cleared otherwise
+        if user_mask & 4:
+            bits = perm_sum & mask_u
+            perm_u = bits if op_eq else perm_u | bits if op_plus_eq else perm_u & ~bits
+            setuid_bit = (
+                4
+                if has_s and op_plus_eq
+                else setuid_bit
+                if not has_s and (not op_eq or is_directory)
+                else 0
+            )
+        if user_mask & 2:
+            bits = perm_sum & mask_g
+            perm_g = bits if op_eq else perm_g | bits if op_plus_eq else perm_g & ~bits
+            setgid_bit = (
+                2
+                if has_s and op_plus_eq
+                else setgid_bit
+                if not has_s and (not op_eq or is_directory)
+                else 0
+            )
+        if user_mask & 1:
+            bits = perm_sum & mask_o
+            perm_o = bits if op_eq else perm_o | bits if op_plus_eq else perm_o & ~bits
+            sticky_bit = (
+                1
+                if has_t and op_plus_eq
+                else sticky_bit
+                if not has_t and not op_eq
+                else 0
+            )
+
+    # Combine the numeric file modes for the owner, group, and others into a single numeric file mode
+    return (
+        ((setuid_bit | setgid_bit | sticky_bit) << 9)
+        | (perm_u << 6)
+        | (perm_g << 3)
+        | perm_o
+    )
+
 
 def symbolic_to_numeric_permissions(
     symbolic_perm: str,
@@ -44,7 +270,7 @@ def symbolic_to_numeric_permissions(
         is_directory (bool, optional): A boolean indicating whether the file is a directory.
                 This affects the behavior of the `X` permission. Defaults to False.
         umask (int, optional): Umask to use for "=[modes]" operation.  If not specified, the
-                system umask will be used.
+                system umask will be used (probed once and then cached).
 
     Returns:
         int: The numeric (octal) representation of the file permissions.
@@ -63,124 +289,105 @@ def symbolic_to_numeric_permissions(
         0o640
     """
 
-    #  Helpers
-    def update_perm(operation: str, instruction_perms: int, current_perm: int) -> int:
-        "Apply `operation` to the current perms and the instruction_perms"
-        if operation == "=":
-            return instruction_perms
-        if operation == "+":
-            return current_perm | instruction_perms
-        return current_perm & ~instruction_perms
-
-    def parse_instructions(permstr: str) -> Iterator[Tuple[str, str, str]]:
-        """Parse the instruction into (lhs, op, rhs).  This also expands
-        multi-operation expressions into multiple u/op/perm tuples."""
-        rx = re.compile(r"([=+-][rwxXstugo]*)")
-        for instruction in permstr.split(","):
-            m = rx.split(instruction)
-            if not m:
-                raise ValueError(f"Invalid instruction: {instruction}")
-            user = m[0]
-            for op, perm in [(op_perm[0], op_perm[1:]) for op_perm in m[1::2]]:
-                yield ((user, op, perm))
-
-    def sum_premissions(perms_str: str) -> int:
-        "Turn the permissions part of the statement into the numeric bits set"
-        unique_perms = set(perms_str)
-        if "x" in unique_perms and "X" in unique_perms:
-            unique_perms.remove("X")  # prevent doubling "x" bit
-        perms_sum = sum(
-            perm_values.get(p, perm_values.get(p.upper(), 0)) for p in unique_perms
-        )
-
-        #  handle u/g/o in PERMS
-        if ("u" in perms_str or "g" in perms_str or "o" in perms_str) and len(
-            perms_str
-        ) != 1:
-            raise ValueError(
-                "If u/g/o specified on RHS, only a single letter of u/g/o can be specified"
-            )
-        perms_sum = perms["u"] if perms_str == "u" else perms_sum
-        perms_sum = perms["g"] if perms_str == "g" else perms_sum
-        perms_sum = perms["o"] if perms_str == "o" else perms_sum
-
-        return perms_sum
-
-    def calc_special_bit(
-        value: int,
-        perms_str: str,
-        operation: str,
-        mode_char: str,
-        bit_value: int,
-        override: bool,
-    ) -> int:
-        "Calculate the special bits (suid/sgid/sticky)"
-        if mode_char in perms_str:
-            value = bit_value if operation in "+=" else 0
-        value = (
-            0
-            if mode_char not in perms_str and operation == "=" and not override
-            else value
-        )
-        return value
+    #  get umask from system if not specified
+    if umask is None:
+        umask = _system_umask()
 
-    # Define a mapping of symbolic permission characters to their corresponding numeric values
-    perm_values = {"r": 4, "w": 2, "x": 1, "X": 1 if is_directory else 0, "-": 0}
+    return _sym_to_num_cached(symbolic_perm, initial_mode, is_directory, umask)
 
-    #  bits to shift based on u/g/o
-    shift_by_user = {"u": 6, "g": 3, "o": 0}
 
-    # Extract initial permissions and special bits
-    perms = {
-        "u": (initial_mode >> 6) & 0o7,
-        "g": (initial_mode >> 3) & 0o7,
-        "o": initial_mode & 0o7,
-    }
-    setuid_bit = 4 if initial_mode & 0o4000 else 0
-    setgid_bit = 2 if initial_mode & 0o2000 else 0
-    sticky_bit = 1 if initial_mode & 0o1000 else 0
+def compile_mode(symbolic_perm: str) -> Callable[..., int]:
+    """
+    Pre-parse a symbolic mode string for repeated application.
 
-    #  get umask from system if not specified
-    if umask is None:
-        umask = os.umask(0)
-        os.umask(umask)
-
-    for users, operation, perms_str in parse_instructions(symbolic_perm):
-        #  if file: set X value if current perms have any 'x' bit set
-        if not is_directory:
-            perm_values["X"] = (
-                1 if perms["u"] & 1 or perms["g"] & 1 or perms["o"] & 1 else 0
-            )
+    Returns an `apply(initial_mode=0, is_directory=False, umask=None)` callable
+    equivalent to symbolic_to_numeric_permissions with `symbolic_perm` bound,
+    but with tokenization and validation done once up front.  Useful for
+    config-management style callers that apply one static policy string to
+    many files.
 
-        perm_sum = sum_premissions(perms_str)
+    Raises:
+        ValueError: When the permissions contain some invalid instruction.
 
-        # Update the numeric file mode variables based on the users and operation
-        effective_users = ("u", "g", "o") if users == "" or "a" in users else users
-        for user in effective_users:
-            apply_mask = (~umask if users == "" else 0o7777) >> shift_by_user[user]
-            perms[user] = update_perm(operation, perm_sum & apply_mask, perms[user])
+    Examples:
+        >>> apply_mode = compile_mode("a=rx,u+w")
+        >>> apply_mode()
+        0o755
+    """
+    #  tokenize and validate up front, priming the per-spec cache
+    _instruction_tuple(symbolic_perm)
 
-            #  set special bits
-            if user == "u":
-                setuid_bit = calc_special_bit(
-                    setuid_bit, perms_str, operation, "s", 4, is_directory
-                )
-            if user == "g":
-                setgid_bit = calc_special_bit(
-                    setgid_bit, perms_str, operation, "s", 2, is_directory
-                )
-            if user == "o":
-                sticky_bit = calc_special_bit(
-                    sticky_bit, perms_str, operation, "t", 1, False
+    def apply(
+        initial_mode: int = 0,
+        is_directory: bool = False,
+        umask: Union[int, None] = None,
+    ) -> int:
+        if umask is None:
+            umask = _system_umask()
+        return _sym_to_num_cached(symbolic_perm, initial_mode, is_directory, umask)
+
+    return apply
+
+
+def _chmod_with_stat(
+    path: Union[str, Path], mode: Union[int, str], st_mode: int, is_directory: bool
+) -> None:
+    """Apply `mode` to `path`, reusing an already-known os.stat result.
+    A string `mode` here is always a symbolic mode (octal strings are
+    converted to int before recursion)."""
+    if isinstance(mode, str):
+        mode = symbolic_to_numeric_permissions(
+            mode, initial_mode=stat.S_IMODE(st_mode), is_directory=is_directory
+        )
+    os.chmod(path, mode)
+
+
+#  os.chmod releases the GIL, so overlapping the per-file syscalls pays off
+#  on high-latency filesystems
+_CHMOD_POOL_WORKERS = 16
+
+
+def _recurse_chmod(directory: Union[str, Path], mode: Union[int, str]) -> None:
+    "Recursively apply chmod below `directory`, depth-first"
+    #  prime the umask cache before the pool workers can race the probe
+    if isinstance(mode, str):
+        _system_umask()
+    with ThreadPoolExecutor(max_workers=_CHMOD_POOL_WORKERS) as executor:
+        _recurse_chmod_into(directory, mode, executor)
+
+
+def _recurse_chmod_into(
+    directory: Union[str, Path], mode: Union[int, str], executor: ThreadPoolExecutor
+) -> None:
+    """Chmod everything below `directory`: files in parallel through the
+    executor, directories depth-first after their contents are done (so a
+    mode that drops directory access can't cut off the recursion)."""
+    #  int modes ignore the current mode entirely, so skip the per-entry
+    #  stat (DirEntry.stat(follow_symlinks=True) always costs a syscall)
+    needs_stat = isinstance(mode, str)
+    file_jobs = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                _recurse_chmod_into(entry.path, mode, executor)
+                if needs_stat:
+                    _chmod_with_stat(entry.path, mode, entry.stat().st_mode, True)
+                else:
+                    os.chmod(entry.path, mode)  # type: ignore
+            elif needs_stat:
+                file_jobs.append(
+                    executor.submit(
+                        _chmod_with_stat,
+                        entry.path,
+                        mode,
+                        entry.stat().st_mode,
+                        entry.is_dir(),
+                    )
                 )
-
-    # Combine the numeric file modes for the owner, group, and others into a single numeric file mode
-    return (
-        ((setuid_bit + setgid_bit + sticky_bit) << 9)
-        | (perms["u"] << 6)
-        | (perms["g"] << 3)
-        | (perms["o"])
-    )
+            else:
+                file_jobs.append(executor.submit(os.chmod, entry.path, mode))
+    for job in file_jobs:
+        job.result()
 
 
 def chmod(path: Union[str, Path], mode: Union[int, str], recurse: bool = False) -> None:
@@ -228,29 +435,27 @@ def chmod(path: Union[str, Path], mode: Union[int, str], recurse: bool = False)
     chmod('/path/to/directory', 'u=rwx,g=rx,o=r')
     """
 
-    def recurse_chmod(directory: Union[str, Path], mode: Union[int, str]) -> None:
-        "Recursively apply chmod"
-        for dir_path, dirnames, filenames in os.walk(directory, topdown=False):
-            for filename in filenames:
-                chmod(os.path.join(dir_path, filename), mode, recurse=False)
-            for dirname in dirnames:
-                chmod(os.path.join(dir_path, dirname), mode, recurse=False)
+    #  an int mode with no recursion needs no parsing or stat at all
+    if isinstance(mode, int) and not recurse:
+        os.chmod(path, mode)
+        return
 
-    mode_is_sym_str = type(mode) is str and not set(mode).issubset("01234567")
+    mode_is_sym_str = isinstance(mode, str) and not _OCTAL_DIGITS.issuperset(mode)
+
+    #  convert octal strings up front so the recursion only sees symbolic strings
+    if isinstance(mode, str) and not mode_is_sym_str:
+        mode = int(mode, 8)
 
     if recurse or mode_is_sym_str:
         path_stat = os.stat(path)
         path_is_directory = stat.S_ISDIR(path_stat.st_mode)
         if path_is_directory and recurse:
-            recurse_chmod(path, mode)
-
-    if type(mode) is str:
-        if not mode_is_sym_str:
-            mode = int(mode, 8)
-        else:
-            path_mode = stat.S_IMODE(path_stat.st_mode)  # type: ignore
+            _recurse_chmod(path, mode)
+        if mode_is_sym_str:
             mode = symbolic_to_numeric_permissions(
-                mode, initial_mode=path_mode, is_directory=path_is_directory  # type: ignore
+                mode,  # type: ignore
+                initial_mode=stat.S_IMODE(path_stat.st_mode),
+                is_directory=path_is_directory,
             )
 
     os.chmod(path, mode)  # type: ignore
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 import unittest
-from symbolicmode import symbolic_to_numeric_permissions
+from symbolicmode import compile_mode, symbolic_to_numeric_permissions
 
 
 class TestSymbolicToNumericPermissions(unittest.TestCase):
@@ -191,6 +191,36 @@ class TestSymbolicToNumericPermissions(unittest.TestCase):
         )
 
 
+class TestCompileMode(unittest.TestCase):
+    def test_matches_symbolic_to_numeric_permissions(self):
+        for spec in ("u=rwx,g=rx,o=r", "a=rx,u+w", "u=rwX", "g=u", "=rw"):
+            apply_mode = compile_mode(spec)
+            for initial_mode in (0, 0o644, 0o4755, 0o7777):
+                for is_directory in (False, True):
+                    self.assertEqual(
+                        apply_mode(initial_mode, is_directory, 0o027),
+                        symbolic_to_numeric_permissions(
+                            spec, initial_mode, is_directory, 0o027
+                        ),
+                    )
+
+    def test_basic_application(self):
+        apply_mode = compile_mode("a=rx,u+w")
+        self.assertEqual(apply_mode(), 0o755)
+        self.assertEqual(apply_mode(0o4777, True), 0o4755)
+
+    def test_umask(self):
+        apply_mode = compile_mode("=rw")
+        self.assertEqual(apply_mode(0o4777, False, 0o027), 0o640)
+        self.assertEqual(apply_mode(0o4777, True, 0o027), 0o4640)
+
+    def test_invalid_spec_raises_at_compile_time(self):
+        with self.assertRaises(ValueError):
+            compile_mode("u=go")
+        with self.assertRaises(ValueError):
+            compile_mode("u=rwq")
+
+
 # Run the unit tests
 if __name__ == "__main__":
     unittest.main()